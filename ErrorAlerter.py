@@ -1,15 +1,38 @@
 import os
-from email.mime.text import MIMEText
-from smtplib import SMTP
+from pathlib import Path
+from email.message import EmailMessage
+from smtplib import SMTP, SMTPException
 import ast
+import json
+
+try:
+    import keyring
+except ImportError:
+    keyring = None
 
 class ErrorAlerter():
     
-    _cred_file_name = "\\".join(__file__.split("\\")[0:-1]) + "\\mail_cred_details.txt"
+    _cred_file_name = Path(__file__).with_name("mail_cred_details.txt")
+
+    _smtp_host = "smtp.office365.com"
+    _smtp_port = 587
+    _smtp_timeout = 30
+
+    # service name the passwords are stored under if the OS keyring is used
+    _keyring_service = "sftpmail"
+
+    # parsed (uid, pwd) keyed by (credentials file, file mtime) so repeated instantiations skip the file
+    _creds_cache: dict[tuple[Path,float], tuple[str,str]] = {}
 
-    def __init__(self,receivers: str, subject: str, warning_text: str):
-        self.receivers = receivers
+    def __init__(self,receivers: str, subject: str, warning_text: str, use_keyring: bool = False):
+        if use_keyring and keyring is None:
+            raise Exception("use_keyring requires the keyring package to be installed")
+        self.receivers = [receiver.strip() for receiver in receivers.split(',')]
         self.warning_text = warning_text
+        # if True the password is kept in the OS keyring and only the uid is written to the credentials file
+        self.use_keyring = use_keyring
+        # the authenticated SMTP connection is opened lazily on the first send and then reused
+        self._server = None
         self._load_credentials()
         self.subject = subject
 
@@ -18,13 +41,36 @@ class ErrorAlerter():
         if not os.path.isfile(self._cred_file_name):
             print("No mail_cred_details.txt file found in root")
             self._create_new_credentials_file()
+        key = (self._cred_file_name, os.stat(self._cred_file_name).st_mtime)
+        if key in ErrorAlerter._creds_cache:
+            self.uid, self.pwd = ErrorAlerter._creds_cache[key]
+            return
+
         with open(self._cred_file_name,"r") as f:
             content = f.read()
-            content_str = bytes.fromhex(content).decode("UTF-8")
-            content_dict = ast.literal_eval(content_str)
-            self.uid, self.pwd = content_dict["uid"], content_dict["pwd"]
-            # fails and raises error if uid and pwd can't authenticate
-            self._login_test(self.uid, self.pwd)
+        # files written by older versions are hex encoded and are rewritten once as plain json
+        is_old_format = not content.lstrip().startswith("{")
+        if is_old_format:
+            content = bytes.fromhex(content).decode("UTF-8")
+        try:
+            content_dict = json.loads(content)
+        except json.JSONDecodeError:
+            # older versions wrote a python dict literal
+            content_dict = ast.literal_eval(content)
+
+        uid, pwd = content_dict["uid"], content_dict.get("pwd")
+        # a password in the file is moved to the keyring if it is used
+        if is_old_format or (self.use_keyring and pwd is not None):
+            self._write_credentials_file(uid, pwd)
+            key = (self._cred_file_name, os.stat(self._cred_file_name).st_mtime)
+
+        if self.use_keyring:
+            pwd = keyring.get_password(self._keyring_service, uid)
+        if pwd is None:
+            raise Exception(f"No password was found for {uid}")
+        self.uid, self.pwd = uid, pwd
+        ErrorAlerter._creds_cache[key] = (self.uid, self.pwd)
+        # the credentials are authenticated on the first send instead of paying an extra handshake here
         print("read the ErrorAlert's credentials file!")
         return
 
@@ -38,43 +84,95 @@ class ErrorAlerter():
             # fails and raises error if uid and pwd can't authenticate
             self._login_test(uid,pwd)
 
-            creds = {"uid":uid,"pwd":pwd}
-            with open(self._cred_file_name,"w") as f:
-                f.write(str(creds).encode("UTF-8").hex())
+            self._write_credentials_file(uid, pwd)
             
             print("New credentials file created!")
         else: 
             print("An error will be raised since no credentials are available")
         return
 
+    def _write_credentials_file(self, uid, pwd):
+        creds = {"uid":uid,"pwd":pwd}
+        if self.use_keyring:
+            if pwd is not None:
+                keyring.set_password(self._keyring_service, uid, pwd)
+            creds = {"uid":uid}
+        with open(self._cred_file_name,"w") as f:
+            json.dump(creds, f)
+
     def error_alert(self):
         self._setup_email()
-        self._send_email()
+        server = self._get_server()
+        # the recipients are taken from the To and Cc headers
+        server.send_message(self.message)
 
     def _setup_email(self):
-        self.receivers = self.receivers.split(',')
-        message = MIMEText(str(self.warning_text))
-        message['subject'] = self.subject
+        message = EmailMessage()
+        message.set_content(str(self.warning_text))
+        message['Subject'] = self.subject
         message['From'] = self.uid
         message['To'] = self.receivers[0]
-        message['Cc'] = ';'.join(self.receivers[1:])
+        if len(self.receivers) > 1:
+            message['Cc'] = ', '.join(self.receivers[1:])
         self.message = message
         return 
 
-    @staticmethod
-    def _login_test(uid, pwd):
+    @classmethod
+    def _connect(cls, uid, pwd) -> SMTP:
+        """
+        Opens a new SMTP connection and authenticates it using uid and pwd
+
+        RETURNS:
+            the authenticated SMTP connection
+        """
+        server = SMTP(cls._smtp_host, cls._smtp_port, timeout = cls._smtp_timeout)
         try:
-            with SMTP('smtp.office365.com',587) as server:
-                server.ehlo()
-                server.starttls()
-                server.login(uid,pwd)
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+            server.login(uid,pwd)
+        except Exception:
+            server.close()
+            raise
+        return server
+
+    @classmethod
+    def _login_test(cls, uid, pwd):
+        try:
+            cls._connect(uid, pwd).quit()
         except Exception as e:
             raise Exception(f"Failed to authenticate using the credentials error code is: {e}")
 
-    def _send_email(self):
-        with SMTP('smtp.office365.com',587) as server:
-            server.ehlo()
-            server.starttls()
-            server.login(self.uid,self.pwd)
-            server.sendmail(self.uid,self.receivers,self.message.as_string()) 
-        return
\ No newline at end of file
+    def _get_server(self) -> SMTP:
+        """
+        Returns the cached SMTP connection. The connection is health checked with a NOOP 
+        and a new one is opened if it has not been opened yet or if the check fails.
+        """
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (SMTPException, OSError):
+                pass
+            self.close()
+
+        try:
+            self._server = self._connect(self.uid, self.pwd)
+        except Exception as e:
+            raise Exception(f"Failed to authenticate using the credentials error code is: {e}")
+        return self._server
+
+    def close(self):
+        """
+        Closes the cached SMTP connection if one is open
+        """
+        server, self._server = getattr(self, "_server", None), None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (SMTPException, OSError):
+            server.close()
+
+    def __del__(self):
+        self.close()
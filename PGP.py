@@ -1,5 +1,10 @@
 from gnupg import GPG
 import os
+import json
+import mmap
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
 def foo():
@@ -32,10 +37,13 @@ class PGP:
     
     """
 
-    # make sure default_comment is defined for method add_comment default arg
+    # make sure default_comment is defined if it isn't set on the instance
     default_comment = None
 
     message_beginning_indicator = "-----BEGIN PGP MESSAGE-----"
+
+    # buffer size used when reading and writing files. Larger buffers means fewer read/write calls per file
+    buffer_size = 1 << 16
     
     def __init__(self,  recipient_fp: str, sign_fp: str = None, gpghome : str = "GnuPG", gpgexe : str = None, 
                 gpg_encoding : str = "utf-8", default_comment : Union[str, list[str]] = None):
@@ -54,7 +62,8 @@ class PGP:
 
 
 
-    def encrypt(self, file_path: Union[str, list[str]], always_trust: bool = True, save_file: bool = False, add_default_comment = True, **kwargs) -> list[str]:
+    def encrypt(self, file_path: Union[str, list[str]], always_trust: bool = True, save_file: Union[bool, str] = False, add_default_comment = True, 
+                return_content: bool = None, max_workers: int = None, **kwargs) -> list[str]:
         """
         Encrypts the files specified in a list of paths using the public key matching self.recipient_fp 
         
@@ -64,101 +73,359 @@ class PGP:
         
         KWARGS:
             always_trust (bool): trust the key matching self.recipient_fp?
-            save_file (bool): if true file is saved with suffix .encrypted
+            save_file (bool | str): if true file is saved with suffix .encrypted. The encrypted output is streamed directly to the file.
+                A path can be given instead when a single file is encrypted.
+                An existing .encrypted file newer than the file is reused if it was made with the same keys, comments and options.
+                The options are recorded in a .meta file which is left next to the encrypted file
             add_default_comment (bool): if true default comment is added to the content. self.default_comment must be specified.
+            return_content (bool): if true the encrypted content is returned. Defaults to True unless save_file is True
+            max_workers (int): max number of files encrypted concurrently. Default is the ThreadPoolExecutor default
             **kwargs: any kwargs is supplied to gnupg.GPG.encrypt_file()
         
         RETURNS:
-            list with the encrypted content as strings for each item
+            list with the encrypted content as strings for each item. 
+            If return_content is False the paths to the saved files are returned instead
         """
 
         if isinstance(file_path,str):
             file_path = [file_path]
 
-        content_holder = []
-        for path in file_path:
-            with open(path, "rb") as f:
+        if isinstance(save_file, str) and len(file_path) != 1:
+            raise Exception(f"save_file can only be a path when a single file is encrypted. {len(file_path)} files were given")
+
+        if return_content is None:
+            return_content = not save_file
+
+        options = {
+            "always_trust": always_trust, 
+            "save_file": save_file, 
+            "add_comment": add_default_comment and self.default_comment != None, 
+            "return_content": return_content,
+            **kwargs
+        }
+
+        if len(file_path) == 1:
+            return [self._encrypt_one(file_path[0], **options)]
+
+        # every file is encrypted by its own gpg subprocess, so threads are enough to run them concurrently
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            return list(executor.map(lambda path: self._encrypt_one(path, **options), file_path))
+
+    def _encrypt_one(self, path: str, always_trust: bool, save_file: Union[bool, str], add_comment: bool, return_content: bool, **kwargs) -> str:
+        """
+        Encrypts the file at path. See PGP.encrypt for the args
+
+        RETURNS:
+            the encrypted content as a string, or the path to the saved file if return_content is False
+        """
+        if save_file:
+            output_path = save_file if isinstance(save_file, str) else path + ".encrypted"
+            meta = {
+                "recipient_fp": self.recipient_fp, 
+                "sign_fp": self.sign_fp, 
+                "comments": self.default_comment if add_comment else None,
+                "always_trust": always_trust,
+                # e.g. armor or extra_args change the output. repr keeps values json can't hold comparable
+                "kwargs": repr(sorted(kwargs.items())),
+                # output_path can be given by the caller, so the source file it was made from is recorded too
+                "source": self._file_version(path)
+            }
+            # skip gpg entirely if an up to date file was encrypted with the same keys, comments and options
+            if not self._is_encrypted_file_current(path, output_path, meta):
+                self._encrypt_to_file(path, output_path, always_trust, add_comment, **kwargs)
+                with open(output_path + ".meta", "w") as f:
+                    json.dump(meta, f)
+            if not return_content:
+                return output_path
+            return self._read_mapped(output_path)
+
+        with open(path, "rb", buffering = self.buffer_size) as f:
+            encr_result = self.GPG.encrypt_file(
+                file = f,
+                recipients = self.recipient_fp,
+                sign = self.sign_fp,
+                always_trust = always_trust,
+                **kwargs
+            )
+        
+        if not(encr_result.ok):
+            raise Exception(f"File: {path} was not encrypted correctly with error {encr_result.__dict__['status']}")
+
+        content = encr_result.data
+
+        # remove any carriage return
+        # if this is deleted it creates double linespaces
+        # sometimes content is bytes, sometimes content is str. I don't know why.
+        # bytes are stripped in a single pass before they are converted to string
+        if isinstance(content, bytes):
+            content = content.translate(None, b"\r").decode(self.GPG.encoding)
+        else:
+            content = content.replace("\r","") 
+
+        if add_comment:
+            content = self.add_comment(content)
+        return content
+
+    @staticmethod
+    def _file_version(path: str) -> list:
+        """
+        Absolute path, size and mtime_ns of the file at path. Changes if another file or another version of the file is used
+        """
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def _is_encrypted_file_current(path: str, output_path: str, meta: dict) -> bool:
+        """
+        Checks if output_path is an encryption of the current version of the file at path.
+        The sidecar output_path.meta file must match meta, so a change of source file, keys or comments causes a new encryption
+
+        RETURNS:
+            True if output_path can be reused
+        """
+        meta_path = output_path + ".meta"
+        if not (os.path.isfile(output_path) and os.path.isfile(meta_path)):
+            return False
+        if os.path.getmtime(output_path) < os.path.getmtime(path):
+            return False
+        try:
+            with open(meta_path, "r") as f:
+                return json.load(f) == meta
+        except ValueError:
+            return False
+
+    def _encrypt_to_file(self, path: str, output_path: str, always_trust: bool, add_comment: bool, **kwargs):
+        """
+        Encrypts the file at path and lets gnupg stream the encrypted output directly to output_path.
+        If comments are to be added gnupg writes to a temporary file which is copied line by line to output_path 
+        with the comments inserted after self.message_beginning_indicator.
+
+        ARGS:
+            path (str): path to the file to be encrypted
+            output_path (str): path to the encrypted file
+            always_trust (bool): trust the key matching self.recipient_fp?
+            add_comment (bool): if true self.default_comment is added to the encrypted file
+            **kwargs: any kwargs is supplied to gnupg.GPG.encrypt_file()
+        """
+        gpg_output_path = output_path
+        if add_comment:
+            fd, gpg_output_path = tempfile.mkstemp(suffix = ".encrypted", dir = os.path.dirname(output_path) or None)
+            os.close(fd)
+
+        try:
+            with open(path, "rb", buffering = self.buffer_size) as f:
                 encr_result = self.GPG.encrypt_file(
                     file = f,
                     recipients = self.recipient_fp,
                     sign = self.sign_fp,
                     always_trust = always_trust,
+                    output = gpg_output_path,
                     **kwargs
                 )
-            
+
             if not(encr_result.ok):
                 raise Exception(f"File: {path} was not encrypted correctly with error {encr_result.__dict__['status']}")
 
-            content = encr_result.data
+            if add_comment:
+                self._copy_with_comments(gpg_output_path, output_path)
+        finally:
+            if gpg_output_path != output_path and os.path.isfile(gpg_output_path):
+                os.remove(gpg_output_path)
 
-            # sometimes content is bytes, sometimes content is str. I don't know why.
-            # convert bytes to string
-            if isinstance(content, bytes):
-                content = content.decode(self.GPG.encoding)
+    def _copy_with_comments(self, src_path: str, dst_path: str, comments : Union[str,list[str]] = None):
+        """
+        Copies the armored content at src_path to dst_path in buffered chunks of self.buffer_size, removing any carriage return 
+        and adding comment(s) on the line after self.message_beginning_indicator.
 
-            # remove any carriage return
-            # if this is deleted it creates double linespaces
-            content = content.replace("\r","") 
+        ARGS:
+            src_path (str): path to the armored file
+            dst_path (str): path to the output file
+            comments (str | list[str]): the comment(s) to insert. Default is the self.default_comment attribute
+        """
+        if comments is None:
+            comments = self.default_comment
 
-            if add_default_comment and self.default_comment != None:
-                content = self.add_comment(content)
+        if isinstance(comments, str):
+            comments = [comments]
 
-            if save_file:
-                path += ".encrypted"
-                with open(path,"w") as f:
-                    f.write(content)
-                 
-            content_holder.append(content)
-        return content_holder
+        encoding = self.GPG.encoding
+        indicator = self.message_beginning_indicator.encode(encoding)
+        comment_block = "".join(f"Comment: {comment}\n" for comment in comments).encode(encoding)
 
-    def decrypt(self, file_paths: Union[list[str], str], always_trust = True, save_file = False, **kwargs) -> list[str]:
+        comments_added = False
+        with open(src_path, "rb", buffering = self.buffer_size) as src, open(dst_path, "wb", buffering = self.buffer_size) as dst:
+            for line in src:
+                dst.write(line.replace(b"\r", b""))
+                if not comments_added and indicator in line:
+                    dst.write(comment_block)
+                    comments_added = True
+
+    def decrypt(self, file_paths: Union[list[str], str], always_trust = True, save_file: Union[bool, str] = False, return_content: bool = None, **kwargs) -> list[str]:
         """
         Decrypts the files specified in a list of paths using stored private keys
         
         INPUT:
             file_path (list[str] | str): path to the file to be encrypted
             always_trust  (bool): trust the key matching self.recipient_fp?
-            save_file (bool): if true file is saved with suffix .encrypted
+            save_file (bool | str): if true the decrypted output is streamed to a file which replaces the encrypted file.
+                A path to save the decrypted file to can be given instead when a single file is decrypted
+            return_content (bool): if true the decrypted content is returned. Defaults to True unless save_file is True
             **kwargs: any kwargs is supplied to gnupg.GPG.decrypt_file()
         
         RETURNS:
-            list with the decrypted content as strings for each item
+            list with the decrypted content as strings for each item. 
+            If return_content is False the paths to the saved files are returned instead
         """
 
         if isinstance(file_paths, str):
             file_paths = [file_paths]
 
+        if isinstance(save_file, str) and len(file_paths) != 1:
+            raise Exception(f"save_file can only be a path when a single file is decrypted. {len(file_paths)} files were given")
+
+        if return_content is None:
+            return_content = not save_file
+
         content_holder = []
         for path in file_paths:
-            with open(path, "r") as f:
-                # check if file is encrypted
-                if  self.message_beginning_indicator not in f.readlines():
+            with open(path, "rb", buffering = self.buffer_size) as f:
+                if not self._is_encrypted(f):
                     print("It does not look as if the file is PGP encrypted")
+                    if isinstance(save_file, str):
+                        print("The file is saved without decryption")
+                        with open(save_file, "wb", buffering = self.buffer_size) as dst:
+                            shutil.copyfileobj(f, dst, self.buffer_size)
+                        content_holder.append(self._read_mapped(save_file) if return_content else save_file)
+                        continue
                     print("Returns the file content without decryption and without saving file if specified")
-                    f.seek(0,0)
-                    content_holder.append(f.read())
+                    if return_content or not save_file:
+                        f.seek(0,0)
+                        content_holder.append(f.read().decode(self.GPG.encoding))
+                    else:
+                        content_holder.append(path)
                     continue
 
                 f.seek(0,0)
-                decrypted = self.GPG.decrypt_file(
-                    file = f,
-                    always_trust = always_trust,
-                    **kwargs
-                )
-            
-            if not decrypted.ok:
-                raise Exception(f"File: {path} was not decrypted correctly with error message {decrypted.__dict__['status']}")
-
-            content = decrypted.data.decode(self.GPG.encoding)
-            
-            if save_file:
-                with open(path, "w") as f:
-                    f.write(content)
-                
-            content_holder.append(content)
+                if save_file:
+                    if isinstance(save_file, str):
+                        path = save_file
+                    self._decrypt_to_file(f, path, always_trust, **kwargs)
+                else:
+                    decrypted = self.GPG.decrypt_file(
+                        file = f,
+                        always_trust = always_trust,
+                        **kwargs
+                    )
+                    if not decrypted.ok:
+                        raise Exception(f"File: {path} was not decrypted correctly with error message {decrypted.__dict__['status']}")
+                    content_holder.append(decrypted.data.decode(self.GPG.encoding))
+                    continue
+
+            if return_content:
+                content_holder.append(self._read_mapped(path))
+            else:
+                content_holder.append(path)
         return content_holder
 
-    def add_comment(self, content : str, comments : Union[str,list[str]] = default_comment) -> str:
+    def encrypt_to_file(self, src_path: str, dst_path: str, always_trust: bool = True, add_default_comment = True, **kwargs) -> str:
+        """
+        Encrypts the file at src_path using the public key matching self.recipient_fp. 
+        The encrypted output is streamed to dst_path without being held in memory
+
+        ARGS:
+            src_path (str): path to the file to be encrypted
+            dst_path (str): path to the encrypted file
+
+        KWARGS:
+            always_trust (bool): trust the key matching self.recipient_fp?
+            add_default_comment (bool): if true default comment is added to the content. self.default_comment must be specified.
+            **kwargs: any kwargs is supplied to gnupg.GPG.encrypt_file()
+
+        RETURNS:
+            dst_path
+        """
+        self._encrypt_to_file(src_path, dst_path, always_trust, add_default_comment and self.default_comment != None, **kwargs)
+        return dst_path
+
+    def decrypt_to_file(self, src_path: str, dst_path: str, always_trust: bool = True, **kwargs) -> str:
+        """
+        Decrypts the file at src_path using stored private keys. 
+        The decrypted output is streamed to dst_path without being held in memory. 
+        If the file is not PGP encrypted it is copied to dst_path as is
+
+        ARGS:
+            src_path (str): path to the file to be decrypted
+            dst_path (str): path to the decrypted file
+
+        KWARGS:
+            always_trust (bool): trust the key matching self.recipient_fp?
+            **kwargs: any kwargs is supplied to gnupg.GPG.decrypt_file()
+
+        RETURNS:
+            dst_path
+        """
+        with open(src_path, "rb", buffering = self.buffer_size) as f:
+            if not self._is_encrypted(f):
+                print("It does not look as if the file is PGP encrypted")
+                print("The file is copied without decryption")
+                with open(dst_path, "wb", buffering = self.buffer_size) as dst:
+                    shutil.copyfileobj(f, dst, self.buffer_size)
+                return dst_path
+            self._decrypt_to_file(f, dst_path, always_trust, **kwargs)
+        return dst_path
+
+    def _is_encrypted(self, f) -> bool:
+        """
+        Checks if the open file f starts with self.message_beginning_indicator. 
+        The armor header is always at the top of the file so only the head is read. f is moved back to the start
+
+        ARGS:
+            f (file object): file opened in binary mode
+        """
+        head = f.read(64)
+        f.seek(0,0)
+        return head.lstrip().startswith(self.message_beginning_indicator.encode(self.GPG.encoding))
+
+    def _decrypt_to_file(self, f, output_path: str, always_trust: bool, **kwargs):
+        """
+        Decrypts the open file f and lets gnupg stream the decrypted output to output_path.
+        gnupg writes to a temporary file in the same folder which then replaces output_path, 
+        since output_path might be the file being decrypted.
+
+        ARGS:
+            f (file object): the encrypted file opened in binary mode
+            output_path (str): path to the decrypted file
+            always_trust (bool): trust the key matching self.recipient_fp?
+            **kwargs: any kwargs is supplied to gnupg.GPG.decrypt_file()
+        """
+        fd, gpg_output_path = tempfile.mkstemp(suffix = ".decrypted", dir = os.path.dirname(output_path) or None)
+        os.close(fd)
+        try:
+            decrypted = self.GPG.decrypt_file(
+                file = f,
+                always_trust = always_trust,
+                output = gpg_output_path,
+                **kwargs
+            )
+            if not decrypted.ok:
+                raise Exception(f"File: {f.name} was not decrypted correctly with error message {decrypted.__dict__['status']}")
+            f.close()
+            os.replace(gpg_output_path, output_path)
+        finally:
+            if os.path.isfile(gpg_output_path):
+                os.remove(gpg_output_path)
+
+    def _read_mapped(self, path: str) -> str:
+        """
+        Reads the file at path through a memory map and decodes it without an intermediate bytes copy
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+                return str(mapped, self.GPG.encoding)
+
+    def add_comment(self, content : str, comments : Union[str,list[str]] = None) -> str:
         """
         Adds a comment(s) to the content arg
         comments are added on the line after self.message_beginning_indicator string (default is -----BEGIN PGP MESSAGE-----)
@@ -173,25 +440,24 @@ class PGP:
             supplied content string with comments added
         """
         # ensure instance value is used as default if comments == None
-        if comments == PGP.default_comment:
+        if comments is None:
             comments = self.default_comment
 
         if isinstance(comments, str):
             comments = [comments]
 
-        row_after_message_begin = None
-        content = content.split("\n")
-        for i,row in enumerate(content):
-            if self.message_beginning_indicator in row:
-                row_after_message_begin = i + 1
-                break
-        
-        for comment in comments:
-            comment = f"Comment: {comment}"
-            content.insert(row_after_message_begin, comment)
+        message_begin = content.find(self.message_beginning_indicator)
+        if message_begin == -1:
+            raise Exception(f"Could not add comments since {self.message_beginning_indicator} was not found in the content")
 
-        content = "\n".join(content)
-        return content
+        # only the header is located, the rest of the content is sliced as a whole
+        row_after_message_begin = content.find("\n", message_begin) + 1
+        if row_after_message_begin == 0:
+            content += "\n"
+            row_after_message_begin = len(content)
+
+        comment_block = "".join(f"Comment: {comment}\n" for comment in comments)
+        return content[:row_after_message_begin] + comment_block + content[row_after_message_begin:]
         
 
     def add_new_local_key(self, paths: Union[list[str], str]):
@@ -211,7 +477,7 @@ class PGP:
 
         import_results = []
         for path in paths:
-            with open(path,'rb') as f:
+            with open(path,'rb', buffering = self.buffer_size) as f:
                 key = f.read()
                 import_result = self.GPG.import_keys(key)
             import_results.append(import_result)
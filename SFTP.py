@@ -1,19 +1,135 @@
-from pysftp import Connection, CnOpts
-from typing import Callable, Union
+from pysftp import Connection, CnOpts, ConnectionException, CredentialException
+from paramiko import SFTPAttributes, SFTPClient, SSHException, Transport
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import IO, Callable, Union
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from SFTPMail import PGP
 import os
+import copy
+import errno
 import shutil
+import socket
+import stat
+import threading
+import tempfile
+import posixpath
 
-class SFTPDecor:
-    @classmethod
-    def _open_connection_decorator(self, func: Callable):
-        """
-        Decorator to execute Callable within the context of the SFTP connection
-        """
-        def _open_connection(*args, **kwargs):
-            with Connection(**args[0].connection_properties) as sftp:
-                return func(*args, sftp = sftp, **kwargs)
-        return _open_connection
+class _FileError(Exception):
+    """
+    Base of the errors raised for files. When raised for a batch of files, 
+    errors maps the name of each failed file to its exception
+    """
+    def __init__(self, message: str, errors: dict[str, Exception] = None):
+        super().__init__(message)
+        self.errors = errors or {}
+
+class EncryptionError(_FileError):
+    """
+    Raised when a file can't be en/decrypted by the selected cryption method
+    """
+
+class TransferError(_FileError):
+    """
+    Raised when a file can't be transferred to or from the server
+    """
+
+@lru_cache(maxsize = 16)
+def _load_cnopts(knownhosts: str, mtime_ns: int) -> CnOpts:
+    """
+    Parses the known hosts file once per path and file version (mtime_ns is part of the cache key)
+    """
+    return CnOpts(knownhosts)
+
+@lru_cache(maxsize = 1)
+def _no_hostkeys_cnopts() -> CnOpts:
+    """
+    CnOpts without host key checking. Built once per process
+    """
+    cnopts = CnOpts()
+    cnopts.hostkeys = None
+    return cnopts
+
+def _make_socket(host: str, port: int, buffer_size: int = None) -> socket.socket:
+    """
+    Connects a TCP socket to host:port with Nagle's algorithm disabled.
+    The send/receive buffers are only set if buffer_size is given, since a set buffer size turns off the OS's TCP buffer autotuning 
+    and is capped at the OS's configured max (net.core.rmem_max/wmem_max on linux). 
+    The buffers are set before connecting so the TCP window scaling can make use of them
+    """
+    try:
+        addresses = socket.getaddrinfo(host, port, type = socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise ConnectionException(host, port)
+
+    error = None
+    for family, sock_type, proto, _, address in addresses:
+        sock = socket.socket(family, sock_type, proto)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if buffer_size is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+class _TunedConnection(Connection):
+    """
+    pysftp.Connection whose paramiko.Transport runs on a socket from _make_socket and opens channels with larger window and packet sizes.
+    pysftp has no argument for the socket or transport, so the transport is created by overriding Connection._start_transport
+    """
+    def __init__(self, window_size: int, max_packet_size: int, socket_buffer_size: int, **connection_properties):
+        self._window_size = window_size
+        self._max_packet_size = max_packet_size
+        self._socket_buffer_size = socket_buffer_size
+        super().__init__(**connection_properties)
+
+    def _start_transport(self, host, port):
+        sock = _make_socket(host, port, self._socket_buffer_size)
+        self._transport = Transport(
+            sock, 
+            default_window_size = self._window_size, 
+            default_max_packet_size = self._max_packet_size
+        )
+        # Set security ciphers if set
+        if self._cnopts.ciphers is not None:
+            self._transport.get_security_options().ciphers = self._cnopts.ciphers
+
+@contextmanager
+def _channel_pool(transport: Transport, max_workers: int):
+    """
+    ThreadPoolExecutor whose worker threads each open one SFTP channel of transport and reuse it for all their tasks, 
+    so no more than max_workers channels are open at a time.
+
+    RETURNS:
+        (executor, channel) where channel() returns the SFTPClient of the calling worker thread. The channels are closed on exit
+    """
+    local = threading.local()
+    clients = []
+    lock = threading.Lock()
+
+    def channel() -> SFTPClient:
+        client = getattr(local, "client", None)
+        # a channel closed by an error is replaced
+        if client is None or client.sock.closed:
+            client = SFTPClient.from_transport(transport)
+            if client is None:
+                raise SSHException("The server refused to open an SFTP channel")
+            local.client = client
+            with lock:
+                clients.append(client)
+        return client
+
+    try:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            yield executor, channel
+    finally:
+        for client in clients:
+            client.close()
 
 class SFTP:
     """
@@ -31,40 +147,163 @@ class SFTP:
                 private_key_pass (str): password to use, if private_key is encrypted
                 cnopts (str): path to a readable file containing information on known hosts
                 default_path (str): set a default path upon connection
+                compression (bool) *Default True*: use zlib compression on the connection
+                window_size (int) *Default 4 MB*: SSH window size of the SFTP channels
+                max_packet_size (int) *Default 256 KB*: max SSH packet size of the SFTP channels
+                socket_buffer_size (int) *Default None*: size of the TCP send and receive buffers. 
+                    By default the OS autotunes the buffers, which a set size turns off
+        pgp (PGP): used by the "PGP" cryption method
+        confirm (Callable[[str], str]) *Default input*: asks the user the setup questions and returns the answer
 
     ATTRIBUTES:
         connection_properties (dict[str]): contains the connection properties. 
             If cnopts is specified its made into an instance of CnOpts
+
+    The connection is opened on first use and reused by later calls until close() is called. 
+    The object can be used as a context manager to close the connection on exit:
+        with SFTP(connection_properties) as sftp:
+            sftp.send_to(...)
+            sftp.receive_from(...)
+    or a batch of calls can be wrapped in a single connection using session():
+        with sftp.session():
+            sftp.send_to(...)
     """
 
+    # instances only hold these attributes, so no per-instance __dict__ is created
+    __slots__ = ("connection_properties", "pgp", "_sftp", "_dir_cache", "_name_lock", "_confirm", 
+                 "_window_size", "_max_packet_size", "_socket_buffer_size")
+
     # defines the paths required to run the class.
     # if missing these paths will be created in the working directory
     required_paths = ["Inbox","Outbox","Sent","Awaiting"]
 
-    def __init__(self, connection_properties: dict[str], pgp : PGP = None):
+    # completed setup checks keyed by (working directory, mtime of the working directory)
+    _setup_cache: dict[tuple[str,float], bool] = {}
+
+    # (process id, working directory) of the last completed setup check. The process id makes a forked process check again
+    _setup_verified: tuple[int,str] = None
+
+    # default number of files transferred concurrently, each on its own SFTP channel. 
+    # Kept below the sessions servers allow per connection (OpenSSH's MaxSessions is 10)
+    default_max_workers = 4
+
+    def __init__(self, connection_properties: dict[str], pgp : PGP = None, confirm: Callable[[str], str] = input):
+        self._confirm = confirm
         self._check_if_setup()
         self.connection_properties = self._connection_properties_check(connection_properties)
         self.pgp = pgp
+        self._sftp = None
+        # names in the local folders. Reset on every send_to/receive_from call
+        self._dir_cache: dict[str, set[str]] = {}
+        # makes sure two files handled at the same time can't be given the same local name
+        self._name_lock = threading.Lock()
+
+    def __enter__(self):
+        self._get_conn()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager keeping one SFTP connection open for all send_to/receive_from calls within the block.
+        The connection is closed on exit, unless it was already open when the block was entered (nested sessions)
+
+        RETURNS:
+            pysftp.Connection
+        """
+        opened_here = self._sftp is None
+        sftp = self._get_conn()
+        try:
+            yield sftp
+        finally:
+            if opened_here:
+                self.close()
 
+    def _get_conn(self) -> Connection:
+        """
+        Returns the open SFTP connection. A new connection is opened if none is open or if the open one has been closed
+
+        RETURNS:
+            pysftp.Connection
+        """
+        if self._sftp is not None:
+            try:
+                if not self._sftp.sftp_client.get_channel().closed:
+                    return self._sftp
+            except Exception:
+                pass
+            self.close()
+
+        self._sftp = self._connect()
+        return self._sftp
+
+    def _connect(self) -> Connection:
+        """
+        Opens a new SFTP connection on a tuned socket and transport
+        """
+        return _TunedConnection(
+            window_size = self._window_size, 
+            max_packet_size = self._max_packet_size, 
+            socket_buffer_size = self._socket_buffer_size, 
+            **self.connection_properties
+        )
+
+    def _with_conn(self, func: Callable, *args, **kwargs):
+        """
+        Executes func within the context of a new short-lived SFTP connection which is closed afterwards.
+        The connection is passed as the first arg to func
 
+        RETURNS:
+            the return value of func
+        """
+        with self._connect() as sftp:
+            return func(sftp, *args, **kwargs)
+
+    def close(self):
+        """
+        Closes the SFTP connection if one is open
+        """
+        sftp, self._sftp = getattr(self, "_sftp", None), None
+        if sftp is not None:
+            sftp.close()
 
     def _connection_properties_check(self, connection_properties):
         if "host" not in connection_properties.keys():
             raise ValueError("Excepted a value for host in connection_properties")
 
+        # the caller's dict is left as is, so it can be used for more than one SFTP obj
+        connection_properties = dict(connection_properties)
+
+        # transport tuning for bulk transfers. These are not arguments of pysftp.Connection
+        self._window_size = connection_properties.pop("window_size", 2**22)
+        self._max_packet_size = connection_properties.pop("max_packet_size", 2**18)
+        self._socket_buffer_size = connection_properties.pop("socket_buffer_size", None)
+        compression = connection_properties.pop("compression", True)
+
         # removes need for user to import pysftp.CnOpts
         if "cnopts" in connection_properties.keys():
             try:
-                connection_properties["cnopts"] = CnOpts(connection_properties["cnopts"])
+                knownhosts = os.path.abspath(connection_properties["cnopts"])
+                cnopts = _load_cnopts(knownhosts, os.stat(knownhosts).st_mtime_ns)
             except Exception as e:
-                raise(f"Failed to instantiate CnOpts obj with the specified cnopts parameter. The error was {e}")
+                raise Exception(f"Failed to instantiate CnOpts obj with the specified cnopts parameter. The error was {e}")
         else:
             # https://stackoverflow.com/questions/38939454/verify-host-key-with-pysftp
             print("It is advised to add a cnopts parameter to check for known host. Current connection is susceptible to man-in-the-middle attacks")
-            cnopts = CnOpts()
-            cnopts.hostkeys = None
+            cnopts = _no_hostkeys_cnopts()
             print("cnopts.hostkeys has been set to = None")
-            connection_properties["cnopts"] = cnopts
+
+        # the cached CnOpts is shared, so options are set on a copy. The parsed host keys are not copied
+        cnopts = copy.copy(cnopts)
+        # pysftp enables compression on the transport from cnopts.compression
+        cnopts.compression = compression
+        connection_properties["cnopts"] = cnopts
 
         return connection_properties    
 
@@ -81,30 +320,58 @@ class SFTP:
         RETURNS:
             list of output paths for created encrypted file
         """
+        if isinstance(file_paths,str):
+            file_paths = [file_paths]
+        return [self._PGP_one(file_path, encrypt_or_decrypt) for file_path in file_paths]
 
+    def _PGP_one(self, file_path: str, encrypt_or_decrypt: str, **kwargs) -> str:
+        """
+        PGP en/decrypts a single file, see _PGP
+
+        RETURNS:
+            output path for the created file
+        """
         if self.pgp == None:
             raise Exception("The SFTP obj must have an assigned pgp value. Can be assigned during initialization.")
-        
-        if isinstance(file_paths,str):
-            file_paths = [file_paths]
 
-        file_names = [os.path.basename(file_path) for file_path in file_paths]
-        
+        file_name = os.path.basename(file_path)
+
+        # the en/decrypted output is streamed directly to the output file
         if encrypt_or_decrypt.lower() == "encrypt":
-            file_content = self.pgp.encrypt(file_paths) 
-            file_output_paths = [self._non_conflicting_name("Outbox",file_name) for file_name in file_names]   
+            file_output_path = self._non_conflicting_name("Outbox",file_name)
+            self.pgp.encrypt_to_file(file_path, file_output_path)
         elif encrypt_or_decrypt.lower() == "decrypt":
-            file_content = self.pgp.decrypt(file_paths)
-            file_output_paths = [self._non_conflicting_name("Inbox",file_name) for file_name in file_names]
-        
-        for content, path in zip(file_content, file_output_paths):
-            with open(path, "w") as f:
-                f.write(content)
-        return file_output_paths
+            file_output_path = self._non_conflicting_name("Inbox",file_name)
+            self.pgp.decrypt_to_file(file_path, file_output_path)
+        return file_output_path
+
+    def _PGP_temp(self, file_path: str) -> str:
+        """
+        PGP encrypts the file at file_path using the PGP object passed to SFTP into a temporary file. 
+        gnupg streams the encrypted output directly to the file, so the content is never held in memory.
+
+        ARGS:
+            file_path (str): path to the file
+
+        RETURNS:
+            path to the temporary file containing the encrypted content. The caller removes it
+        """
+        if self.pgp == None:
+            raise Exception("The SFTP obj must have an assigned pgp value. Can be assigned during initialization.")
+
+        fd, temp_path = tempfile.mkstemp(suffix = ".encrypted")
+        os.close(fd)
+        try:
+            self.pgp.encrypt_to_file(file_path, temp_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path
 
     def _no_cryption(self, file_paths: Union[str,list[str]], encrypt_or_decrypt, **kwargs) -> list[str]:
         """
-        Applies encryption to files and simply copies them to the Inbox/Outbox for further processing. Returns output path.
+        Applies no encryption to files and simply moves them to the Inbox/Outbox for further processing. Returns output path.
+        Files are renamed, and only copied if the destination is on another filesystem.
         output path if encrypt_or_decrypt = "encrypt" is Outbox\\file_name
         output path if encrypt_or_decrypt = "decrypt" is Inbox\\file_name
 
@@ -117,118 +384,334 @@ class SFTP:
         """
         if isinstance(file_paths, str):
             file_paths = [file_paths]
+        return [self._no_cryption_one(file_path, encrypt_or_decrypt) for file_path in file_paths]
 
+    def _no_cryption_one(self, file_path: str, encrypt_or_decrypt: str, **kwargs) -> str:
+        """
+        Moves a single file to the Inbox/Outbox, see _no_cryption
+
+        RETURNS:
+            output path for file
+        """
         if encrypt_or_decrypt.lower() == "encrypt":
             dst_folder = "Outbox"
         elif encrypt_or_decrypt.lower() == "decrypt":
             dst_folder = "Inbox"
-        file_names = [os.path.basename(file_path) for file_path in file_paths]
-        file_output_paths = [self._non_conflicting_name(dst_folder,file_name) for file_name in file_names]
+        file_output_path = self._non_conflicting_name(dst_folder,os.path.basename(file_path))
 
-        for src,dst in zip(file_paths,file_output_paths):
-            shutil.copy2(src,dst)
-        return file_output_paths
+        try:
+            os.rename(file_path,file_output_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(file_path,file_output_path)
+        return file_output_path
     
     cryption_methods = {"None":_no_cryption, "PGP": _PGP}
+    # what send_to ("encrypt") and receive_from ("decrypt") apply to a single file for the built in cryption methods, used by _cryptor.
+    # send_to sends the Outbox file itself, so nothing is done without encryption and PGP encrypts to a temporary file
+    _single_cryptors = {
+        ("None", "encrypt"): None,
+        ("None", "decrypt"): lambda self, file_path: self._no_cryption_one(file_path, "decrypt"),
+        ("PGP", "encrypt"): _PGP_temp,
+        ("PGP", "decrypt"): lambda self, file_path: self._PGP_one(file_path, "decrypt"),
+    }
+
+    def _cryptor(self, cryption_method: str, encrypt_or_decrypt: str) -> Union[Callable[[str], str], None]:
+        """
+        Looks up the cryption method once and binds it to self and encrypt_or_decrypt
 
-    @SFTPDecor._open_connection_decorator
-    def send_to(self, remote_dst: str, cryption_method: str = "None", **kwargs) -> None:
+        RETURNS:
+            function taking the path to a single file and returning the output path, 
+            or None if the file is used as it is
+        """
+        if cryption_method not in self.cryption_methods:
+            raise Exception(f"Unknown cryption method: {cryption_method}. Options are {list(self.cryption_methods)}")
+        key = (cryption_method, encrypt_or_decrypt)
+        if key in self._single_cryptors:
+            single = self._single_cryptors[key]
+            return None if single is None else partial(single, self)
+        # methods added to cryption_methods take and return lists of paths
+        method = self.cryption_methods[cryption_method]
+        return lambda file_path: method(self, file_path, encrypt_or_decrypt)[0]
+
+    def send_to(self, remote_dst: str, cryption_method: str = "None", max_workers: int = None, **kwargs) -> None:
         """
         Sends all files in the Outbox folder to the specified remote_path using SFTP.
-        Prior to being sent files are placed in the Awaiting folder.
+        Files are encrypted and streamed concurrently on a few SFTP channels of the open connection, 
+        so the encryption of one file overlaps the upload of another. 
+        The files are moved to the Sent folder once all transfers have finished.
+        Files that fail to be encrypted or sent are left in the Outbox folder. 
+        If more than a third of the files fail the remaining transfers are cancelled.
+        Failed files raise a TransferError, or an EncryptionError if they all failed to be encrypted, see _raise_failed
 
         INPUT:
             remote_dst (str): path to the remote destination
+            max_workers (int): max number of files transferred concurrently. Default is one per file up to default_max_workers
+        """
+        self._dir_cache = {}
+        sftp = self._get_conn()
+
+        # the transfer channels don't share the connection's remote directory (e.g. default_path), so the path is made absolute
+        remote_dst = sftp.normalize(remote_dst)
+
+        # get the files in the Outbox, the directory entries cache their type and size
+        with os.scandir("Outbox") as it:
+            entries = [entry for entry in it if entry.is_file(follow_symlinks = False)]
+
+        encrypt = self._cryptor(cryption_method, "encrypt")
+
+        if max_workers is None:
+            max_workers = min(self.default_max_workers, len(entries)) or 1
+
+        failed = {}
+        with _channel_pool(sftp._transport, max_workers) as (executor, channel):
+            futures = {
+                executor.submit(self._send_file, channel, entry, posixpath.join(remote_dst,entry.name), encrypt): entry 
+                for entry in entries
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    failed[futures[future].name] = future.exception()
+                    # abort the batch if too many files fail
+                    if len(failed) > len(entries) / 3:
+                        for pending in futures:
+                            pending.cancel()
+
+        # Move the sent files to sent
+        sent_entries = [futures[future] for future in futures if not future.cancelled() and future.exception() is None]
+        for entry in sent_entries:
+            sent_path = self._non_conflicting_name("Sent",entry.name)
+            os.rename(entry.path,sent_path)
+
+        if len(sent_entries) != len(entries):
+            self._raise_failed(f"Failed to put {len(entries) - len(sent_entries)} of {len(entries)} files on the server", failed)
+
+    def _send_file(self, channel: Callable[[], SFTPClient], entry: os.DirEntry, remote_path: str, 
+                   encrypt: Callable[[str], str] = None):
         """
-        # get the sftp Connection passed from _open_connection_decorator as a kwarg
-        sftp = kwargs.pop("sftp")
+        Applies encrypt to the Outbox file and streams the result to remote_path.
+        Without encrypt the file is sent directly from the Outbox.
+        Any encrypted file created is removed once sent
 
-        # get relative path to files
-        file_names = os.listdir("Outbox")
+        INPUT:
+            channel (Callable): returns the SFTPClient of the worker thread, see _channel_pool
+            encrypt (Callable): takes the path to the file and returns the path to the content to send
+        """
+        file_size = None
+        try:
+            if encrypt is None:
+                source = entry.path
+                file_size = entry.stat(follow_symlinks = False).st_size
+            else:
+                source = encrypt(entry.path)
+        except Exception as e:
+            raise EncryptionError(f"Encryption failed, error code was: {e}") from e
 
-        for file_name in file_names:
-            outbox_path = os.path.join("Outbox",file_name)
-            awaiting_path = self._non_conflicting_name("Awaiting",file_name)
-            # make sure the same file can't mistakently be sent twice
-            os.rename(outbox_path,awaiting_path)
-            remote_path = os.path.join(remote_dst,file_name)
-            
-            # make sure exception can run and the wanted Exception is reached
-            file_to_send_path = ["temp"]
+        try:
+            self._put_file(channel(), source, remote_path, file_size)
+        except (SSHException, OSError) as e:
+            raise TransferError(f"Transfer failed, error code was: {e}") from e
+        finally:
+            self._remove_encrypted_copy(source, entry.path)
+
+    @staticmethod
+    def _raise_failed(message: str, failed: dict[str, Exception]):
+        """
+        Raises the error of a batch of files. It is an EncryptionError if every file failed to be en/decrypted, otherwise a TransferError.
+        The exception of each failed file is kept in the errors attribute and the first one is the cause
 
-            # If the system fails put the file from awaiting back into the Outbox before throwing an error
-            try:
-                # apply selected encryption method to file and return path of encrypted file
-                file_to_send_path = self.cryption_methods[cryption_method](self, awaiting_path, "encrypt")
-                assert len(file_to_send_path) == 1
-                # make list[str] into str (should only contain one item)
-                file_to_send_path = file_to_send_path[0]
-                # Copy file to remote destination
-                sftp.put(file_to_send_path,remote_path)
-            except Exception as e:
-                # is run if self.cryption_methods fail in the above
-                if file_to_send_path[0] == "temp":
-                    os.rename(awaiting_path, outbox_path)
-                    raise Exception(f"Encryption failed, error code was: {e}")
-                
-                # clean created files (if any) and move awaiting back to outbox before failing
-                if file_to_send_path[0] != awaiting_path and os.path.isfile(file_to_send_path[0]):
-                    os.remove(file_to_send_path)
-                os.rename(awaiting_path, outbox_path)
-                raise Exception(f"Failed to put file {file_name} on the server. The error was {e}")
-            
-            # make sure any created encrypted file is deleted
-            if os.path.isfile(file_to_send_path):
-                os.remove(file_to_send_path)
-            
-            # Move file to sent
-            sent_path = self._non_conflicting_name("Sent",file_name)
-            os.rename(awaiting_path,sent_path)
+        INPUT:
+            message (str): description of the failed batch
+            failed (dict): the exception of each failed file keyed by the file name
+        """
+        errors = list(failed.values())
+        error_type = EncryptionError if all(isinstance(e, EncryptionError) for e in errors) else TransferError
+        details = "; ".join(f"{file_name}: {e}" for file_name, e in failed.items())
+        raise error_type(f"{message}. The errors were {details}", failed) from errors[0]
 
+    @staticmethod
+    def _remove_encrypted_copy(source: str, outbox_path: str):
+        """
+        Removes the encrypted file created from the Outbox file, whether it was sent or not. 
+        The Outbox file itself is left to be moved to Sent or kept for the next send_to
+        """
+        if source != outbox_path and os.path.isfile(source):
+            os.remove(source)
 
-    @SFTPDecor._open_connection_decorator
-    def receive_from(self, remote_path: str, cryption_method: str = "None", **kwargs) -> list[str]:
+    @staticmethod
+    def _put_file(sftp_client: SFTPClient, source: str, remote_path: str, file_size: int = None):
         """
-        Fetch all files on the remote path and place them into the local Inbox folder
+        Streams the local file at source to remote_path using sftp_client
 
         INPUT:
-            remote_path (str): path to the remote destination from which files are fetched
+            source (str): path to a local file
+        KWARGS:
+            file_size (int): size of the local file if already known, saves a stat call
+        """
+        with SFTP._open_local_stream(source, "rb", 1 << 16) as f:
+            if file_size is None:
+                file_size = os.fstat(f.fileno()).st_size
+            sftp_client.putfo(f, remote_path, file_size = file_size, confirm = True)
+
+    def receive_from(self, remote_path: str = None, cryption_method: str = "None", max_workers: int = None, **kwargs) -> list[str]:
+        """
+        Fetch all files on the remote path and place them into the local Inbox folder.
+        Files are fetched and decrypted concurrently on a few SFTP channels of the open connection, 
+        so the decryption of one file overlaps the download of another.
+        Files that fail to be fetched or decrypted are left on the server.
+        Failed files raise a TransferError, or an EncryptionError if they all failed to be decrypted, see _raise_failed
+
+        INPUT:
+            remote_path (str): path to the remote destination from which files are fetched. Default is the current remote directory
+            max_workers (int): max number of files transferred concurrently. Default is one per file up to default_max_workers
         RETURNS:
-            list of local paths to the files fetched from the server
+            list of local paths to the fetched files after decryption
         """
-        # get the sftp Connection passed from _open_connection_decorator as a kwarg
-        sftp = kwargs.pop("sftp")
+        self._dir_cache = {}
+        sftp = self._get_conn()
+
+        # the transfer channels don't share the connection's remote directory (e.g. default_path), so the path is made absolute
+        remote_path = sftp.normalize(remote_path or ".")
+
+        # the attributes of all remote files are fetched in a single round trip. Folders and links are skipped
+        remote_files = [attributes for attributes in sftp.listdir_attr(remote_path) if stat.S_ISREG(attributes.st_mode)]
+
+        if max_workers is None:
+            max_workers = min(self.default_max_workers, len(remote_files)) or 1
 
-        fetched_files = []
-        remote_files = sftp.listdir(remote_path)
-        for file_name in remote_files:
-            remote_file_path = os.path.join(remote_path, file_name)
-            # make sure a unique name is given to the file
-            local_path = self._non_conflicting_name("Awaiting",file_name)
-            sftp.get(remote_file_path,local_path, preserve_mtime = True)
-            fetched_files.append(local_path)
-            sftp.remove(remote_file_path)
+        decrypt = self._cryptor(cryption_method, "decrypt")
 
-        # path to decrypted files. Files are created in or copied to Inbox directory
-        decrypted_fetched_files = self.cryption_methods[cryption_method](self, fetched_files, "decrypt")
+        with _channel_pool(sftp._transport, max_workers) as (executor, channel):
+            futures = {
+                executor.submit(self._fetch_file, channel, remote_path, attributes, decrypt): attributes.filename
+                for attributes in remote_files
+            }
+            # exception() and result() wait for the downloads
+            failed = {futures[future]: future.exception() for future in futures if future.exception() is not None}
+            decrypted_fetched_files = [future.result() for future in futures if future.exception() is None]
 
-        # remove encrypted fetched files in awaiting
-        [os.remove(fetched_file) for fetched_file in fetched_files]
+            # the fetched files are removed from the server in one batch once the downloads are done. 
+            # The removal reuses the workers and their channels
+            fetched_remote_files = [posixpath.join(remote_path, futures[future]) for future in futures if future.exception() is None]
+            self._remove_remote_files(executor, channel, fetched_remote_files, max_workers)
+
+        if failed:
+            self._raise_failed(f"Failed to fetch {len(failed)} of {len(remote_files)} files from the server", failed)
 
         return decrypted_fetched_files
 
+    def _fetch_file(self, channel: Callable[[], SFTPClient], remote_path: str, attributes: SFTPAttributes, decrypt: Callable[[str], str]) -> str:
+        """
+        Fetches a remote file into the Awaiting folder on the SFTP channel of the worker thread 
+        and applies decrypt, which places the file in the Inbox
+
+        RETURNS:
+            local path to the decrypted file
+        """
+        remote_file_path = posixpath.join(remote_path, attributes.filename)
+        # make sure a unique name is given to the file
+        local_path = self._non_conflicting_name("Awaiting",attributes.filename)
+
+        try:
+            try:
+                self._get_file(channel(), remote_file_path, local_path, attributes)
+            except (SSHException, OSError) as e:
+                raise TransferError(f"Transfer failed, error code was: {e}") from e
+
+            # path to decrypted file. The file is created in or moved to Inbox directory
+            try:
+                decrypted_path = decrypt(local_path)
+            except Exception as e:
+                raise EncryptionError(f"Decryption failed, error code was: {e}") from e
+        finally:
+            # remove the encrypted file in awaiting. A file moved by the cryption method is already gone
+            if os.path.isfile(local_path):
+                os.remove(local_path)
+        return decrypted_path
+
+    @staticmethod
+    def _remove_remote_files(executor: ThreadPoolExecutor, channel: Callable[[], SFTPClient], remote_file_paths: list[str], max_workers: int):
+        """
+        Removes the remote files. The files are split between the max_workers workers of a _channel_pool, 
+        so the server always has requests to work on
+        """
+        def remove_files(paths):
+            sftp_client = channel()
+            for path in paths:
+                sftp_client.remove(path)
+
+        batches = [remote_file_paths[i::max_workers] for i in range(max_workers) if remote_file_paths[i::max_workers]]
+        # list() makes sure any exception is raised
+        list(executor.map(remove_files, batches))
+
+    @staticmethod
+    def _get_file(sftp: Union[Connection, SFTPClient], remote_file_path: str, local_path: str, attributes: SFTPAttributes = None):
+        """
+        Streams the remote file to local_path with read-ahead (prefetch) of the remote file, 
+        so SSH packets are received while the local file is written. The remote mtime is preserved.
+        Where supported the local file is allocated at its full size up front instead of growing with every write.
+
+        INPUT:
+            attributes (SFTPAttributes): attributes of the remote file e.g. from listdir_attr. Fetched with stat if not given
+        """
+        if attributes is None:
+            attributes = sftp.stat(remote_file_path)
+        with sftp.open(remote_file_path, "rb") as remote_file:
+            # files which fit in a single read request gain nothing from the read-ahead
+            if attributes.st_size > remote_file.MAX_REQUEST_SIZE:
+                remote_file.prefetch(attributes.st_size)
+            with SFTP._open_local_stream(local_path, "wb", 1 << 20) as local_file:
+                if attributes.st_size and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(local_file.fileno(), 0, attributes.st_size)
+                    except OSError:
+                        # preallocation is not supported on all filesystems
+                        pass
+                shutil.copyfileobj(remote_file, local_file, 1 << 20)
+                # cut off any preallocated space not written, if the remote file shrank since it was listed
+                local_file.truncate()
+        os.utime(local_path, (attributes.st_atime, attributes.st_mtime))
+
+    @staticmethod
+    def _open_local_stream(path: str, mode: str, buffering: int) -> IO[bytes]:
+        """
+        Opens the local side of a transfer. Files read for upload are read sequentially from start to end, 
+        which is passed on to the kernel where supported, so it reads ahead from disk while the previous chunk is sent
+
+        INPUT:
+            path (str): path to the local file
+            mode (str): "rb" or "wb"
+            buffering (int): buffer size of the file object
+        """
+        f = open(path, mode, buffering = buffering)
+        if "r" in mode and hasattr(os, "posix_fadvise"):
+            try:
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                # advice is not supported on all filesystems
+                pass
+        return f
+
     def test_connection(self) -> dict:
+        """
+        Tests whether a connection can be made to the remote machine. 
+        If a connection is already open, e.g. within session(), that connection is checked instead of opening a new one
 
-        @SFTPDecor._open_connection_decorator
-        def test_func(*args, **kwargs):
-            return
-        
+        RETURNS:
+            dict with keys OK (bool) and Exception (the exception raised if OK is False)
+        """
         result = {"OK":True, "Exception":None}
 
         try:
-            test_func(self)
+            if self._sftp is not None:
+                self._get_conn()
+            else:
+                self._with_conn(lambda sftp: None)
             return result
-        except Exception as e:
+        except (SSHException, OSError, ConnectionException, CredentialException) as e:
             result["Exception"] = e
             result["OK"] = False
             return result
@@ -237,7 +720,8 @@ class SFTP:
     def _non_conflicting_name(self, destination_path: str, file_name: str) -> str:
         """
         Check if the filename already exists within the local folder.
-        If there's a conflict add _x (where x is a number) to make a non-conflicting file name
+        If there's a conflict add _x (where x is a number) to make a non-conflicting file name.
+        The folder is read once per send_to/receive_from call and the names given out are added to the cached names
 
         INPUT:
             destination_path (str): relative local path to a folder
@@ -246,41 +730,57 @@ class SFTP:
         RETURNS:
             (str) non-conflicting filename
         """
-        file_path = os.path.join(destination_path, file_name)
-        iterator = 0
-        while os.path.exists(file_path):
-            iterator += 1
-
-            # add '_x' as suffix to the file name
-            file_path_split = file_path.split(".")
-            file_path_split[0] = file_path_split[0] + "_" + str(iterator)
-            file_path_try = ".".join(file_path_split)
-
-            # check if new file path exists
-            if not os.path.exists(file_path_try):
-                file_path = file_path_try
-                break
-            
-        return file_path
+        # read the folder once and find a free name in memory
+        # names are compared with normcase since windows paths are case insensitive
+        with self._name_lock:
+            existing = self._dir_cache.get(destination_path)
+            if existing is None:
+                with os.scandir(destination_path) as entries:
+                    existing = {os.path.normcase(entry.name) for entry in entries}
+                self._dir_cache[destination_path] = existing
+
+            stem, ext = os.path.splitext(file_name)
+            non_conflicting_file_name = file_name
+            iterator = 0
+            while os.path.normcase(non_conflicting_file_name) in existing:
+                iterator += 1
+                # add '_x' as suffix to the file name
+                non_conflicting_file_name = f"{stem}_{iterator}{ext}"
+
+            existing.add(os.path.normcase(non_conflicting_file_name))
+        return os.path.join(destination_path, non_conflicting_file_name)
 
 
     def _check_if_setup(self):
         """
-        Check if the current working directory contains the required paths
+        Check if the current working directory contains the required paths.
+        A completed check is cached on the working directory and its mtime, so it is skipped until the directory changes.
+        Once verified in this process only the Inbox is checked
         """
-        files_in_dir = os.listdir()
-        paths_in_folder = []
-        for path in self.required_paths:
-            paths_in_folder.append(path in files_in_dir)
+        cwd = os.getcwd()
+        if SFTP._setup_verified == (os.getpid(), cwd) and os.path.isdir("Inbox"):
+            return True
+
+        key = (cwd, os.stat(".").st_mtime)
+        if SFTP._setup_cache.get(key) is True:
+            SFTP._setup_verified = (os.getpid(), cwd)
+            return True
 
-        if not all(paths_in_folder):
+        with os.scandir() as entries:
+            files_in_dir = {entry.name for entry in entries}
+        paths_missing = [path for path in self.required_paths if path not in files_in_dir]
+
+        if paths_missing:
             print("It seems as if you are missing some of the required paths.")
             user_response = self._prompt_new_setup()
             if not user_response:
                 return
-            paths_missing = self._find_missing_paths(paths_in_folder)
             self._setup(paths_missing = paths_missing, no_warning = True)
+            # creating the folders changes the mtime of the working directory
+            key = (cwd, os.stat(".").st_mtime)
 
+        SFTP._setup_cache[key] = True
+        SFTP._setup_verified = (os.getpid(), cwd)
         return True
 
 
@@ -294,7 +794,7 @@ class SFTP:
         print(f"""
             The current working directory was found to be missing some of the required folders.
             If current paths exists, and they contain any important information, you should as a precaution move these files to a path outside the working directory""")
-        response = input("Do you wish to make a new setup? (Y/N): ")
+        response = self._confirm("Do you wish to make a new setup? (Y/N): ")
         
         if response.lower() != "y":
             print("Setup was not run and the SFTP class is shutting down")
@@ -302,24 +802,6 @@ class SFTP:
         return True
     
 
-    def _find_missing_paths(self,paths_in_folder: list[str]) -> list[str]:
-        """
-        Check if the paths_in_folder arg contains the required strings.
-
-        INPUT:
-            paths_in_folder (list[str]): contains the files/folders in the current working directory. 
-            Relative paths from current working directory.
-
-        RETURNS:
-            list[str]: required relative paths missing in the current working directory
-        """
-        paths_missing = []
-        for path, path_in_folder in zip(self.required_paths, paths_in_folder):
-            if not path_in_folder:
-                paths_missing.append(path)
-        return paths_missing
-
-
     def _setup(self, paths_missing: list[str] = False, no_warning = False):
         """
         Creates the paths in the paths_missing arg
@@ -330,7 +812,7 @@ class SFTP:
         """
         if not no_warning:
             print("You are about to make a new setup. Any files within the current working directory could potentially be compromised.")
-            response = input("Are you sure that you wish to do this? (Y/N): ")
+            response = self._confirm("Are you sure that you wish to do this? (Y/N): ")
             if response.lower() != "y":
                 print("Setup was not run")
                 return
@@ -1,3 +1,3 @@
-from SFTPMail.SFTP import SFTP
+from SFTPMail.SFTP import SFTP, EncryptionError, TransferError
 from SFTPMail.PGP import PGP
 from SFTPMail.ErrorAlerter import ErrorAlerter
\ No newline at end of file
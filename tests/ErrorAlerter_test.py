@@ -0,0 +1,113 @@
+import json
+import pytest
+from smtplib import SMTPServerDisconnected
+
+from SFTPMail import ErrorAlerter
+
+
+@pytest.fixture
+def cred_file(monkeypatch, tmp_path):
+    """
+    Credentials file in the test's tmp folder used in place of mail_cred_details.txt
+    """
+    cred_file = tmp_path / "mail_cred_details.txt"
+    monkeypatch.setattr(ErrorAlerter, "_cred_file_name", cred_file)
+    monkeypatch.setattr(ErrorAlerter, "_creds_cache", {})
+    return cred_file
+
+
+def test_old_credentials_file_is_rewritten_as_json(cred_file):
+    """
+    Test that a hex encoded credentials file written by older versions is loaded and rewritten as plain json
+    """
+    creds = {"uid": "alerts@example.com", "pwd": "secret"}
+    cred_file.write_text(str(creds).encode("UTF-8").hex())
+
+    alerter = ErrorAlerter("receiver@example.com", "subject", "warning")
+
+    assert (alerter.uid, alerter.pwd) == (creds["uid"], creds["pwd"])
+    assert json.loads(cred_file.read_text()) == creds
+
+
+def test_json_credentials_file_is_loaded_once(cred_file, mocker):
+    """
+    Test that a json credentials file is read once and left as is
+    """
+    creds = {"uid": "alerts@example.com", "pwd": "secret"}
+    cred_file.write_text(json.dumps(creds))
+    json_loads = mocker.spy(json, "loads")
+
+    first = ErrorAlerter("receiver@example.com", "subject", "warning")
+    second = ErrorAlerter("receiver@example.com", "subject", "warning")
+
+    assert (first.uid, first.pwd) == (second.uid, second.pwd) == (creds["uid"], creds["pwd"])
+    assert json_loads.call_count == 1
+    assert cred_file.read_text() == json.dumps(creds)
+
+
+@pytest.fixture
+def alerter(cred_file):
+    """
+    ErrorAlerter with credentials read from the tmp credentials file
+    """
+    cred_file.write_text(json.dumps({"uid": "alerts@example.com", "pwd": "secret"}))
+    return ErrorAlerter("first@example.com, second@example.com,third@example.com", "subject", "warning")
+
+
+@pytest.fixture
+def smtp(mocker):
+    """
+    Fake SMTP class patched into ErrorAlerter. Every instance is a new fake server answering NOOP with 250
+    """
+    smtp = mocker.patch("SFTPMail.ErrorAlerter.SMTP")
+    smtp.side_effect = lambda *args, **kwargs: mocker.MagicMock(**{"noop.return_value": (250, b"OK")})
+    return smtp
+
+
+def test_error_alert_reuses_connection(alerter, smtp):
+    """
+    Test that the connection is opened on the first alert and reused by the next
+    """
+    assert smtp.call_count == 0
+
+    alerter.error_alert()
+    alerter.error_alert()
+
+    assert smtp.call_count == 1
+    server = alerter._server
+    server.login.assert_called_once_with("alerts@example.com", "secret")
+    assert server.noop.call_count == 1
+    assert server.send_message.call_count == 2
+
+
+def test_error_alert_reconnects_after_failed_noop(alerter, smtp):
+    """
+    Test that a new connection is opened if the cached one fails the NOOP health check, and that the old one is closed
+    """
+    alerter.error_alert()
+    old_server = alerter._server
+    old_server.noop.side_effect = SMTPServerDisconnected("Connection unexpectedly closed")
+    old_server.quit.side_effect = SMTPServerDisconnected("Connection unexpectedly closed")
+
+    alerter.error_alert()
+
+    assert smtp.call_count == 2
+    assert alerter._server is not old_server
+    old_server.close.assert_called_once()
+    alerter._server.send_message.assert_called_once()
+
+
+def test_error_alert_headers(alerter, smtp):
+    """
+    Test that the first receiver is the To header and the rest are the Cc header, also when the instance sends more than one alert
+    """
+    alerter.error_alert()
+    alerter.error_alert()
+
+    messages = [call.args[0] for call in alerter._server.send_message.call_args_list]
+    assert len(messages) == 2
+    for message in messages:
+        assert message["From"] == "alerts@example.com"
+        assert message["To"] == "first@example.com"
+        assert message["Cc"] == "second@example.com, third@example.com"
+        assert message["Subject"] == "subject"
@@ -1,126 +1,89 @@
-import pytest
-from SFTPMail import PGP
-from mock import patch
 import os
+import pytest
 
-test_files_folder_path = r"tests\test_files"
-test_file_path = os.path.join(test_files_folder_path,"file.txt")
-new_test_file_path = os.path.join(test_files_folder_path, "file_temp.txt")
-
-def read_test_file():
-    with open(test_file_path, "r") as f:
-        test_file_content = f.read()
-    return test_file_content
-
-test_file_content = read_test_file()
-
-def delete_new_files(files_prior_to_run):
-    for file in os.listdir(test_files_folder_path):
-        if file not in files_prior_to_run:
-            os.remove(os.path.join(test_files_folder_path, file))
-
-
-"""
-FakeGPG and FakeResult is a fake version of the GPG class used in PGP.
-These objs are patched/replaced for testing purposes.
-"""
-
-class FakeResult:
-    ok = True
-    data = b"abcdefghijklmnopqrstuvxyz"
-    status = "foo"
-
-    def __init__(self,data):
-        self.data = data
-
-class FakeGPG:
-
-    encoding = "utf-8"
-
-    def __init__(self, *args,**kwargs):
-        return
-    
-    def encrypt_file(self, *args, **kwargs):
-        return FakeResult(read_test_file().encode(self.encoding))
 
-    
-    def decrypt_file(self, *args, **kwargs):
-        return FakeResult(read_test_file().encode(self.encoding))
+@pytest.mark.parametrize("op", ["encrypt", "decrypt"])
+@pytest.mark.parametrize("save", [False, True])
+def test_roundtrip(pgp, tmp_path, test_file_path, test_file_content, op, save):
+    """
+    Tests whether the file content is anyhow altered by the encrypt/decrypt method, with and without kwarg save_file
+    """
+    kwargs = {"save_file": str(tmp_path / "out"), "return_content": True} if save else {}
+    result = getattr(pgp, op)(test_file_path, **kwargs)
+    assert result == [test_file_content]
 
 
-def fake__init__(self,recipient_fp, *args, **kwargs):
+def test_encrypt_save_reuses_current_file(pgp, tmp_path, mocker):
     """
-    Fake __init__ used to patch the PGP class
+    Tests that a saved encryption is reused, and made again when the file or the encryption options change
     """
-    self.recipient_fp = recipient_fp
-    self.sign_fp = None
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"content")
+    encrypt_file = mocker.spy(pgp.GPG, "encrypt_file")
 
-    self.GPG = FakeGPG()
+    pgp.encrypt(str(path), save_file = True)
+    pgp.encrypt(str(path), save_file = True)
+    assert encrypt_file.call_count == 1
 
+    pgp.encrypt(str(path), save_file = True, always_trust = False)
+    assert encrypt_file.call_count == 2
 
-def test_encrypt_file(mocker):
-    """
-    Tests whether the file content is anyhow altered by the encrypt_file method
-    """
-    mocker.patch.object(PGP,"__init__",fake__init__)
+    pgp.encrypt(str(path), save_file = True, always_trust = False, armor = False)
+    assert encrypt_file.call_count == 3
 
-    gpg = PGP("adfijaodf")
-    result = gpg.encrypt(test_file_path)
-    assert result == test_file_content
+    # the file is changed after it was encrypted
+    encrypted_mtime = os.path.getmtime(str(path) + ".encrypted")
+    os.utime(path, (encrypted_mtime + 10, encrypted_mtime + 10))
+    pgp.encrypt(str(path), save_file = True, always_trust = False, armor = False)
+    assert encrypt_file.call_count == 4
 
 
-def test_encrypt_file_save(mocker):
+@pytest.mark.parametrize("save", [False, True])
+def test_decrypt_armored(pgp, tmp_path, mocker, test_file_bytes, test_file_content, save):
     """
-    Tests whether the file content is anyhow altered by the encrypt_file method with kwarg save_file = True
+    Tests that a file starting with the armor header is passed to GPG.decrypt_file, and that the saved file holds the decrypted content
     """
-    
-    # see files prior to test runs and delete any new files in the folder at the end
-    files_prior_to_run = os.listdir(test_files_folder_path)
-    
-    mocker.patch.object(PGP,"__init__",fake__init__)
-    
+    path = tmp_path / "file.txt.encrypted"
+    path.write_bytes(b"-----BEGIN PGP MESSAGE-----\n\nnot really encrypted\n-----END PGP MESSAGE-----\n")
+    out_path = tmp_path / "out"
+    decrypt_file = mocker.spy(pgp.GPG, "decrypt_file")
 
+    kwargs = {"save_file": str(out_path), "return_content": True} if save else {}
+    result = pgp.decrypt(str(path), **kwargs)
 
+    assert decrypt_file.call_count == 1
+    assert result == [test_file_content]
+    if save:
+        assert out_path.read_bytes() == test_file_bytes
+    else:
+        assert not out_path.exists()
 
-    gpg = PGP("adfijaodf")
-    result = gpg.encrypt(test_file_path,save_file = True)
 
-    delete_new_files(files_prior_to_run)
-    assert result == test_file_content
-
-
-def test_decrypt_file(mocker):
+def test_encrypt_save_path_not_reused_for_other_file(pgp, tmp_path, mocker):
     """
-    Tests whether the file content is anyhow altered by the decrypt_file method
+    Tests that a file saved to an explicit path is encrypted again when another file is saved to the same path
     """
-    mocker.patch.object(PGP,"__init__",fake__init__)
+    first, second = tmp_path / "a.txt", tmp_path / "b.txt"
+    first.write_bytes(b"content a")
+    second.write_bytes(b"content b")
+    # the second file is older than the saved encryption of the first
+    os.utime(second, (0, 0))
+    out_path = str(tmp_path / "out.pgp")
+    encrypt_file = mocker.spy(pgp.GPG, "encrypt_file")
 
-    gpg = PGP("adfijaodf")
-    result = gpg.decrypt(test_file_path)
-    assert result == test_file_content
+    pgp.encrypt(str(first), save_file = out_path)
+    pgp.encrypt(str(second), save_file = out_path)
+    assert encrypt_file.call_count == 2
 
-def test_decrypt_file_save(mocker):
+
+def test_decrypt_not_encrypted_to_save_path(pgp, tmp_path):
     """
-    Tests whether the file content is anyhow altered by the decrypt_file method with kwarg save_file = True
+    Tests that a file which is not encrypted is copied as is when decrypted to an explicit path
     """
+    path = tmp_path / "file.txt"
+    path.write_bytes(b"plain content")
+    out_path = tmp_path / "out"
 
-    # see files prior to test runs and delete any new files in the folder at the end
-    files_prior_to_run = os.listdir(test_files_folder_path)
-
-    mocker.patch.object(PGP,"__init__",fake__init__)
-
-    gpg = PGP("adfijaodf")
-    result = gpg.decrypt(test_file_path, save_file = True)
-
-    delete_new_files(files_prior_to_run)
-
-    assert result == test_file_content
-
-
-# deletes any files created in the folder by the tests
-
-
-
-
-
-
+    assert pgp.decrypt(str(path), save_file = str(out_path)) == [str(out_path)]
+    assert out_path.read_bytes() == b"plain content"
+    assert pgp.decrypt(str(path), save_file = str(out_path), return_content = True) == ["plain content"]
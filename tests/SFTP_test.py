@@ -1,136 +1,330 @@
 import pytest
 import os
-from io import StringIO
 import shutil
+import importlib
+from pathlib import Path
+from types import SimpleNamespace
+import io
+import socket
+import tempfile
+import time
+import mock
+from paramiko import SFTPAttributes, RSAKey
 
+from SFTPMail import SFTP, TransferError
 
 
+class fake_RemoteFile(io.FileIO):
+    """
+    Remote file opened by fake_SFTPClient
+    """
+    MAX_REQUEST_SIZE = 32768
+
+    def prefetch(self, file_size = None):
+        return
+
+
+class fake_SFTPClient:
+    """
+    Fake SFTP channel of a fake_Connection. Remote paths are paths within the connection's root folder
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.sock = SimpleNamespace(closed = False)
+
+    @classmethod
+    def from_transport(cls, transport):
+        return cls(transport)
+
+    def get_channel(self):
+        return self.sock
+
+    def putfo(self, fl, remotepath, file_size = 0, callback = None, confirm = True):
+        if os.path.basename(remotepath) in self.connection.failing_files:
+            raise OSError(f"Failure putting {remotepath}")
+        with open(remotepath, "wb") as f:
+            shutil.copyfileobj(fl, f)
+
+    def open(self, filename, mode = "r", bufsize = -1):
+        return fake_RemoteFile(filename, "rb")
+
+    def remove(self, path):
+        os.remove(path)
+
+    def close(self):
+        self.sock.closed = True
+
 
-import mock
 class fake_Connection:
 
-        def __init__(*args, **kwargs):
-            return
+        # local folder standing in for the server, set by the remote_dir fixture
+        root = None
+        # names of the files the fake server refuses to receive
+        failing_files = set()
+
+        def __init__(self, *args, **kwargs):
+            # the transfer channels are opened with SFTPClient.from_transport(connection._transport)
+            self._transport = self
+            self.sftp_client = fake_SFTPClient(self)
         
-        def __enter__():
-            print("Entering connection")
+        def __enter__(self):
+            return self
         
-        def __exit__():
-            print("Exiting connection")
+        def __exit__(self, *args):
+            return
 
-        def listdir(self):
-            return os.listdir(r"tests\test_files")
+        def normalize(self, remotepath):
+            return os.path.normpath(os.path.join(self.root, remotepath.lstrip("/")))
 
-        def get(self, remote_file_path, local_path):
-            shutil.copy2(remote_file_path,local_path)
+        def listdir_attr(self, remotepath = "."):
+            with os.scandir(remotepath) as entries:
+                return [SFTPAttributes.from_stat(entry.stat(), entry.name) for entry in entries]
 
-        def remove(self, path):
-            return
+        def close(self):
+            self.sftp_client.close()
 
-mock.patch("SFTP.Connection",fake_Connection).start()
 
-from SFTPMail import SFTP
+connection_properties = {"host":"abcdefg.000.000.000"}
 
 
+@pytest.fixture(scope = "module", autouse = True)
+def patched_sftp():
+    """
+    Replaces the connection and the transfer channels opened by SFTP with fake_Connection/fake_SFTPClient
+    for the tests in this module
+    """
+    # SFTPMail.SFTP is the class re-exported by the package, so the module is looked up explicitly
+    sftp_module = importlib.import_module("SFTPMail.SFTP")
+    with mock.patch.object(sftp_module, "_TunedConnection", fake_Connection), \
+            mock.patch.object(sftp_module, "SFTPClient", fake_SFTPClient):
+        yield
 
 
-connection_properties = {"host":"abcdefg.000.000.000"}
+@pytest.fixture(autouse = True)
+def working_dir(monkeypatch, tmp_path):
+    """
+    Runs every test in its own empty working directory, so the folders set up by SFTP are never shared between tests 
+    and the tests can run in parallel with pytest -n auto
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
 
 
-sftp = SFTP(connection_properties)
-sftp.receive_from("does not matter")
-print("stop")
-def clean_setup():
+@pytest.fixture
+def sftp_with_setup():
     """
-    Cleans up the files from the SFTP class in the working directory
+    SFTP obj made with the neccessary files for the SFTP class set up in the working directory
     """
-    paths_in_dir = os.listdir()
-    setupped_paths = SFTP.required_paths
-
-    for path in setupped_paths:
-        if path in paths_in_dir:
-            if len(path.split(".")) > 1:
-                os.remove(path)
-            else:
-                os.rmdir(path)
+    return SFTP(connection_properties, confirm = lambda _: "y")
 
 
-def make_setup(monkeypatch):
+@pytest.fixture
+def remote_dir(monkeypatch, working_dir):
     """
-    Function to setup the neccessary files for the SFTP class in the working directory
+    Local folder standing in for the server of fake_Connection
     """
-    response = StringIO("y")
-    monkeypatch.setattr("sys.stdin",response)
-    sftp = SFTP(connection_properties)
-    return sftp
+    remote_dir = working_dir / "remote"
+    remote_dir.mkdir()
+    monkeypatch.setattr(fake_Connection, "root", str(remote_dir))
+    monkeypatch.setattr(fake_Connection, "failing_files", set())
+    return remote_dir
 
 
-def test_setup_yes(monkeypatch):
+@pytest.fixture
+def sftp_inst(patched_sftp, sftp_with_setup, remote_dir):
     """
-    Test whether the needed paths are created if user says yes
+    Set up SFTP obj connecting to the fake server in remote_dir. The connection is closed after the test
     """
-    make_setup(monkeypatch)
+    yield sftp_with_setup
+    sftp_with_setup.close()
 
-    setupped_paths = SFTP.required_paths
-    paths_in_dir = os.listdir()
 
-    # setup no longer needed so clean asap
-    clean_setup()
-    for path in setupped_paths:
-        if path not in paths_in_dir:
-            assert False, f"The path {path} which was required to be set up is missing from the working directory"
+def test_setup_yes(sftp_with_setup):
+    """
+    Test whether the needed paths are created if user says yes
+    """
+    missing = set(SFTP.required_paths) - set(os.listdir())
+    assert not missing, f"The paths {missing} which were required to be set up are missing from the working directory"
 
-def test_setup_no(monkeypatch):
+def test_setup_no():
     """
     Test whether the needed paths are NOT created if the user says no
     """
-    response = StringIO("n")
-    monkeypatch.setattr("sys.stdin",response)
     before_setup = os.listdir()
-    sftp = SFTP(connection_properties)
+    sftp = SFTP(connection_properties, confirm = lambda _: "n")
     after_setup = os.listdir()
 
     assert before_setup == after_setup, "Setup was denied and the content of the working directory should not have been changed, but it has"
 
-def test_setup_already_exists(monkeypatch):
+def test_setup_already_exists(sftp_with_setup):
     """
     Test if _check_if_setup indicates that the setup is already in place
     """
-    sftp = make_setup(monkeypatch)
-    is_already_setup = sftp._check_if_setup()
-    clean_setup()
+    is_already_setup = sftp_with_setup._check_if_setup()
     assert is_already_setup
 
 
+def test_cnopts_cached_per_known_hosts_version(working_dir):
+    """
+    Test that the known hosts file is parsed once, and parsed again when the file changes
+    """
+    known_hosts = working_dir / "known_hosts"
+    key = RSAKey.generate(1024)
+    known_hosts.write_text(f"{connection_properties['host']} {key.get_name()} {key.get_base64()}\n")
+    properties = {**connection_properties, "cnopts": str(known_hosts)}
 
+    first = SFTP(properties, confirm = lambda _: "y").connection_properties["cnopts"]
+    second = SFTP(properties, confirm = lambda _: "y").connection_properties["cnopts"]
+    assert second.hostkeys is first.hostkeys
 
-# use to test SFTP.receive_from and SFTP.send_to using a mocker 
-# I haven't had success with it yet 
-# # https://opensource.com/article/21/9/unit-test-python
-def to_test_network_dependent_calls():
-    class fake_Connection:
+    mtime = os.path.getmtime(known_hosts)
+    os.utime(known_hosts, (mtime + 10, mtime + 10))
+    third = SFTP(properties, confirm = lambda _: "y").connection_properties["cnopts"]
+    assert third.hostkeys is not first.hostkeys
 
-        def __init__(*args, **kwargs):
-            return
-        
-        def __enter__():
-            print("Entering connection")
-        
-        def __exit__():
-            print("Exiting connection")
 
-        def listdir(self):
-            return os.listdir(r"tests\test_files")
+@pytest.mark.parametrize("buffer_size", [None, 1 << 20])
+def test_make_socket_buffers(buffer_size):
+    """
+    Test that the socket buffers are left to the OS unless a size is given. TCP_NODELAY is always set
+    """
+    sftp_module = importlib.import_module("SFTPMail.SFTP")
+    with socket.create_server(("127.0.0.1", 0)) as server, socket.socket() as default_sock:
+        sock = sftp_module._make_socket("127.0.0.1", server.getsockname()[1], buffer_size)
+        with sock:
+            assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            rcvbuf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if buffer_size is None:
+                assert rcvbuf == default_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            else:
+                assert rcvbuf != default_sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
 
-        def get(self, remote_file_path, local_path):
-            shutil.copy2(remote_file_path,local_path)
 
-        def remove(self, path):
-            return
+def test_cryptor(sftp_with_setup):
+    """
+    Test that send_to and receive_from get the cryption methods from _cryptor
+    """
+    assert sftp_with_setup._cryptor("None", "encrypt") is None
+    assert sftp_with_setup._cryptor("PGP", "encrypt").func is SFTP._PGP_temp
+    assert sftp_with_setup._cryptor("None", "decrypt") is not None
+    with pytest.raises(Exception, match = "Unknown cryption method"):
+        sftp_with_setup._cryptor("ROT13", "encrypt")
+
+
+def test_send_to(sftp_inst, remote_dir):
+    """
+    Test that the files in the Outbox are put on the server and moved to Sent
+    """
+    (remote_dir / "out").mkdir()
+    files = {f"file_{i}.txt": f"content {i}".encode() for i in range(6)}
+    for file_name, content in files.items():
+        Path("Outbox", file_name).write_bytes(content)
+
+    sftp_inst.send_to("/out")
+
+    assert {path.name: path.read_bytes() for path in (remote_dir / "out").iterdir()} == files
+    assert os.listdir("Outbox") == []
+    assert sorted(os.listdir("Sent")) == sorted(files)
+
+
+def test_receive_from(sftp_inst, remote_dir):
+    """
+    Test that the files on the server are fetched to the Inbox and removed from the server
+    """
+    (remote_dir / "in").mkdir()
+    files = {f"file_{i}.txt": f"content {i}".encode() for i in range(6)}
+    for file_name, content in files.items():
+        (remote_dir / "in" / file_name).write_bytes(content)
+
+    fetched = sftp_inst.receive_from("/in")
+
+    assert sorted(fetched) == sorted(os.path.join("Inbox", file_name) for file_name in files)
+    assert {file_name: Path("Inbox", file_name).read_bytes() for file_name in files} == files
+    assert os.listdir(remote_dir / "in") == []
+    assert os.listdir("Awaiting") == []
+
+
+def test_receive_from_skips_folders(sftp_inst, remote_dir):
+    """
+    Test that folders on the server are left as they are and don't fail the other files
+    """
+    (remote_dir / "in" / "folder").mkdir(parents = True)
+    (remote_dir / "in" / "file.txt").write_bytes(b"content")
+
+    fetched = sftp_inst.receive_from("/in")
+
+    assert fetched == [os.path.join("Inbox", "file.txt")]
+    assert os.listdir(remote_dir / "in") == ["folder"]
+
+
+def test_send_to_failure_removes_encrypted_copy(sftp_inst, remote_dir, monkeypatch, pgp):
+    """
+    Test that a file which fails to be sent is left in the Outbox and its temporary encrypted file is removed
+    """
+    (remote_dir / "out").mkdir()
+    temp_dir = remote_dir.parent / "temp"
+    temp_dir.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    sftp_inst.pgp = pgp
+    files = [f"file_{i}.txt" for i in range(6)]
+    for file_name in files:
+        Path("Outbox", file_name).write_bytes(b"content")
+    fake_Connection.failing_files.add("file_0.txt")
+
+    with pytest.raises(TransferError, match = "Failed to put 1 of 6 files") as error:
+        sftp_inst.send_to("/out", cryption_method = "PGP")
+
+    assert list(error.value.errors) == ["file_0.txt"]
+    assert error.value.__cause__ is error.value.errors["file_0.txt"]
+    assert isinstance(error.value.__cause__, TransferError)
+    assert isinstance(error.value.__cause__.__cause__, OSError)
+
+    assert os.listdir("Outbox") == ["file_0.txt"]
+    assert sorted(os.listdir("Sent")) == files[1:]
+    assert sorted(os.listdir(remote_dir / "out")) == files[1:]
+    assert os.listdir(temp_dir) == []
+
+
+def test_send_to_aborts_when_a_third_fails(sftp_inst, remote_dir, monkeypatch):
+    """
+    Test that the remaining transfers are cancelled once more than a third of the files have failed
+    """
+    (remote_dir / "out").mkdir()
+    files = [f"file_{i}.txt" for i in range(30)]
+    for file_name in files:
+        Path("Outbox", file_name).write_bytes(b"content")
+    fake_Connection.failing_files.update(files)
+
+    attempts = []
+    putfo = fake_SFTPClient.putfo
+    def slow_putfo(self, fl, remotepath, *args, **kwargs):
+        attempts.append(remotepath)
+        # gives send_to the time to cancel the pending transfers
+        time.sleep(0.01)
+        return putfo(self, fl, remotepath, *args, **kwargs)
+    monkeypatch.setattr(fake_SFTPClient, "putfo", slow_putfo)
+
+    with pytest.raises(TransferError, match = "Failed to put 30 of 30 files"):
+        sftp_inst.send_to("/out", max_workers = 1)
+
+    assert len(attempts) < len(files)
+    assert sorted(os.listdir("Outbox")) == sorted(files)
+    assert os.listdir("Sent") == []
+
+
+
+def test_send_to_keeps_existing_sent_files(sftp_inst, remote_dir):
+    """
+    Test that files sent with the name of a file already in Sent get a non-conflicting name, also when sent in the same call
+    """
+    (remote_dir / "out").mkdir()
+    Path("Sent", "file.txt").write_bytes(b"old")
+    Path("Sent", "file_1.txt").write_bytes(b"older")
+    Path("Outbox", "file.txt").write_bytes(b"new")
+    Path("Outbox", "file_1.txt").write_bytes(b"newer")
 
+    sftp_inst.send_to("/out")
 
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            with fake_Connection(**args[0].connection_properties) as sftp:
-                func(*args, sftp = sftp, **kwargs)
-        return wrapper
\ No newline at end of file
+    sent = {path.name: path.read_bytes() for path in Path("Sent").iterdir()}
+    assert sent == {"file.txt": b"old", "file_1.txt": b"older", "file_2.txt": b"new", "file_1_1.txt": b"newer"}
@@ -0,0 +1,82 @@
+import pytest
+from SFTPMail import PGP
+from functools import partialmethod
+from pathlib import Path
+import os
+
+test_files_folder_path = Path(__file__).parent / "test_files"
+
+
+@pytest.fixture(scope = "session")
+def test_file_path():
+    return os.fspath(test_files_folder_path / "file.txt")
+
+@pytest.fixture(scope = "session")
+def test_file_bytes(test_file_path):
+    """
+    Content of the test file, read once per test session
+    """
+    with open(test_file_path, "rb") as f:
+        return f.read()
+
+@pytest.fixture(scope = "session")
+def test_file_content(test_file_bytes):
+    return test_file_bytes.decode("utf-8")
+
+
+"""
+FakeGPG and FakeResult is a fake version of the GPG class used in PGP.
+These objs are patched/replaced for testing purposes.
+"""
+
+class FakeResult:
+    ok = True
+    data = b"abcdefghijklmnopqrstuvxyz"
+    status = "foo"
+
+    def __init__(self,data):
+        self.data = data
+
+class FakeGPG:
+
+    encoding = "utf-8"
+
+    def __init__(self, cached_bytes):
+        self._cached = cached_bytes
+    
+    def encrypt_file(self, *args, output = None, **kwargs):
+        data = self._cached
+        # gnupg writes the result to output and leaves data empty if output is specified
+        if output is not None:
+            with open(output, "wb") as f:
+                f.write(data)
+            return FakeResult(b"")
+        return FakeResult(data)
+
+    
+    def decrypt_file(self, *args, output = None, **kwargs):
+        data = self._cached
+        if output is not None:
+            with open(output, "wb") as f:
+                f.write(data)
+            return FakeResult(b"")
+        return FakeResult(data)
+
+
+def fake__init__(self,recipient_fp, *args, cached, **kwargs):
+    """
+    Fake __init__ used to patch the PGP class. cached is the test file content returned by FakeGPG
+    """
+    self.recipient_fp = recipient_fp
+    self.sign_fp = None
+
+    self.GPG = FakeGPG(cached)
+
+
+@pytest.fixture
+def pgp(mocker, test_file_bytes):
+    """
+    PGP obj using FakeGPG, which returns the test file content
+    """
+    mocker.patch.object(PGP,"__init__",partialmethod(fake__init__, cached = test_file_bytes))
+    return PGP("adfijaodf")